@@ -5,7 +5,10 @@ from __future__ import unicode_literals
 import logging
 import re
 import sys
-from argparse import ArgumentParser
+import threading
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 import psycopg2
 import psycopg2.errorcodes
@@ -14,10 +17,11 @@ import psycopg2.extensions
 # Globals
 import time
 
-from .util import pretty_size, fetch_single_row, fetch_single_val
+from .util import pretty_size, parse_size, fetch_single_row, fetch_single_val
 
 MAINT_DBNAME = 'postgres'  # FIXME: hardcoded
 APPNAME = "PGtool"
+SWAP_RETRY_TIMEOUT = 30  # seconds to keep retrying renames in pg_swap() while sessions exit
 MAX_IDENTIFIER_LEN = 63  # http://www.postgresql.org/docs/current/static/sql-syntax-lexical.html#SQL-SYNTAX-IDENTIFIERS
 log = logging.getLogger('pgtool')
 PY2 = sys.version_info[0] <= 2
@@ -77,6 +81,43 @@ def execute_catch(c, sql, vars=None):
         log.error("Error executing %s: %s", cmd, err)
 
 
+def run_parallel(database, func, items, jobs):
+    """Call func(db, item) for each item, using up to `jobs` worker threads that each have their own connection to
+    database.
+
+    The first error raised in a worker is re-raised in the caller, remaining items are skipped.
+    """
+    pending = list(reversed(items))
+    lock = threading.Lock()
+
+    def worker(_):
+        db = connect(database)
+        try:
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    item = pending.pop()
+                try:
+                    func(db, item)
+                except BaseException:
+                    with lock:
+                        del pending[:]
+                    raise
+        finally:
+            db.close()
+
+    if jobs < 1:
+        raise Abort("Number of jobs must be at least 1")
+    if not items:
+        return
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        pool.map(worker, range(min(jobs, len(items))))
+    finally:
+        pool.terminate()
+
+
 def terminate(db, databases):
     c = db.cursor()
     c.execute("""\
@@ -104,6 +145,12 @@ def db_exists(db, dbname):
     return c.rowcount > 0
 
 
+def has_extension(db, name):
+    c = db.cursor()
+    c.execute("SELECT TRUE FROM pg_catalog.pg_extension WHERE extname=%s", [name])
+    return c.rowcount > 0
+
+
 def generate_alt_dbname(db, basename, alt='tmp'):
     fail = []
     # Try 5 times...
@@ -121,6 +168,79 @@ def generate_alt_dbname(db, basename, alt='tmp'):
     raise Abort("Cannot generate unique database name; tried: %s" % ", ".join(fail))
 
 
+def wal_lsn(db):
+    """Returns the current WAL position, or None if it cannot be measured. For logging only, never fails."""
+    # pg_xlog_location_diff(), needed by wal_bytes_since(), was added in PostgreSQL 9.2
+    if db.server_version < 90200:
+        return None
+    func = 'pg_current_wal_lsn' if db.server_version >= 100000 else 'pg_current_xlog_location'
+    try:
+        return fetch_single_val(db.cursor(), "SELECT pg_catalog.%s()" % func)
+    except psycopg2.Error as err:
+        log.warning("Cannot determine WAL position: %s", str(err).strip())
+        return None
+
+
+def wal_bytes_since(db, lsn):
+    """Returns the WAL volume written since wal_lsn() returned lsn, or None if unknown. Never fails."""
+    if lsn is None:
+        return None
+    if db.server_version >= 100000:
+        sql = "SELECT pg_catalog.pg_wal_lsn_diff(pg_catalog.pg_current_wal_lsn(), %s)"
+    else:
+        sql = "SELECT pg_catalog.pg_xlog_location_diff(pg_catalog.pg_current_xlog_location(), %s)"
+    try:
+        return int(fetch_single_val(db.cursor(), sql, [lsn]))
+    except psycopg2.Error as err:
+        log.warning("Cannot determine WAL volume: %s", str(err).strip())
+        return None
+
+
+def choose_copy_strategy(size, replicas, checkpoint_pending, threshold):
+    """Choose the CREATE DATABASE STRATEGY for copying a database of `size` bytes.
+
+    WAL_LOG writes the whole database to WAL, which every replica has to receive as well, so its cost is counted as
+    size * (1 + replicas) bytes. FILE_COPY instead forces a checkpoint, flushing everything changed since the last
+    one; its cost is checkpoint_pending, the WAL volume written since then in bytes, or None if unknown. The cheaper
+    one is chosen. Databases smaller than `threshold` bytes always use WAL_LOG.
+    """
+    if size < threshold:
+        return 'WAL_LOG'
+    if checkpoint_pending is None:
+        return 'FILE_COPY'
+    # Written locally once, plus once more sent to each replica
+    return 'FILE_COPY' if size * (1 + replicas) > checkpoint_pending else 'WAL_LOG'
+
+
+def pg_copy_strategy(db, size):
+    """Returns the STRATEGY to use for CREATE DATABASE, or None if the server doesn't support it."""
+    if db.server_version < 150000:
+        if args.strategy != 'auto':
+            raise Abort("--strategy requires PostgreSQL 15 or newer")
+        return None
+
+    if args.strategy != 'auto':
+        log.info("Using strategy %s", args.strategy.upper())
+        return args.strategy.upper()
+
+    c = db.cursor()
+    replicas = fetch_single_val(c, "SELECT pg_catalog.count(*) FROM pg_catalog.pg_stat_replication")
+    try:
+        checkpoint_pending = int(fetch_single_val(c, """\
+        SELECT pg_catalog.pg_wal_lsn_diff(pg_catalog.pg_current_wal_lsn(), redo_lsn)
+        FROM pg_catalog.pg_control_checkpoint()
+        """))
+    except psycopg2.Error as err:
+        # Requires superuser or pg_monitor by default
+        log.warning("Cannot determine checkpoint load: %s", str(err).strip())
+        checkpoint_pending = None
+
+    strategy = choose_copy_strategy(size, replicas, checkpoint_pending, args.strategy_threshold)
+    log.info("Using strategy %s: size %s, %d replica(s), %s WAL since last checkpoint", strategy, pretty_size(size),
+             replicas, "unknown" if checkpoint_pending is None else pretty_size(checkpoint_pending))
+    return strategy
+
+
 def pg_copy(db, src, dest):
     if args.force:
         terminate(db, [src, dest])
@@ -131,8 +251,13 @@ def pg_copy(db, src, dest):
     size = fetch_single_val(c, "SELECT pg_database_size(%s)", [src])
     log.info("Duplicating database %s size %s", q_src, pretty_size(size))
 
+    strategy = pg_copy_strategy(db, size)
     sql = "CREATE DATABASE %s TEMPLATE %s" % (q_dest, q_src)
+    if strategy:
+        sql += " STRATEGY %s" % strategy
     log.info("SQL: %s", sql)
+    start_lsn = wal_lsn(db)
+    started = time.time()
     try:
         c.execute(sql)
     # BaseException also includes KeyboardInterrupt, Exception doesn't
@@ -145,6 +270,13 @@ def pg_copy(db, src, dest):
             execute_catch(c, sql)
         raise
 
+    elapsed = time.time() - started
+    wal_bytes = wal_bytes_since(db, start_lsn)
+    if wal_bytes is None:
+        log.info("Copied in %.1fs", elapsed)
+    else:
+        log.info("Copied in %.1fs, wrote %s of WAL", elapsed, pretty_size(wal_bytes))
+
     # Copy database and role settings
     # XXX PostgreSQL 8.4 and older use a different catalog table?
     c.execute("""\
@@ -195,8 +327,107 @@ def pg_drop(db, name):
     c.execute(sql)
 
 
+def set_allow_connections(db, q_name, allow):
+    c = db.cursor()
+    sql = "ALTER DATABASE %s WITH ALLOW_CONNECTIONS %s" % (q_name, 'true' if allow else 'false')
+    log.info("SQL: %s", sql)
+    c.execute(sql)
+
+
+def wait_sessions(db, databases, timeout):
+    """Wait up to `timeout` seconds for all sessions on the databases to end.
+
+    Returns the number of remaining sessions.
+    """
+    c = db.cursor()
+    deadline = time.time() + timeout
+    while True:
+        count = fetch_single_val(c, """\
+        SELECT pg_catalog.count(*) FROM pg_catalog.pg_stat_activity
+            WHERE datname = ANY(%s) AND pid != pg_catalog.pg_backend_pid()
+        """, [databases])
+        if count == 0 or time.time() >= deadline:
+            return count
+        time.sleep(0.1)
+
+
+def pg_swap(db, src, dest):
+    """Rename src to dest, and the existing dest out of the way, minimizing the time clients cannot connect to dest.
+
+    Both databases stop accepting connections, existing sessions are drained, then both renames are done in one
+    transaction. Returns the time in seconds during which clients could not connect to dest.
+    """
+    if db.server_version < 90500:
+        raise Abort("Swapping databases requires PostgreSQL 9.5 or newer")
+
+    c = db.cursor()
+    c.execute("SELECT datname, datallowconn FROM pg_catalog.pg_database WHERE datname = ANY(%s)", [[src, dest]])
+    allow_conn = dict(c.fetchall())
+    for name in (src, dest):
+        if name not in allow_conn:
+            raise Abort("Database %s does not exist" % name)
+
+    backup_db = generate_alt_dbname(db, dest, 'old')
+    q_src, q_dest, q_backup = quote_names(db, (src, dest, backup_db))
+
+    blocked = time.time()
+    swapped = False
+    try:
+        set_allow_connections(db, q_src, False)
+        set_allow_connections(db, q_dest, False)
+
+        count = wait_sessions(db, [src, dest], args.drain_timeout)
+        if count and not args.force:
+            raise Abort("%d session(s) still connected after %gs, use --force to terminate them" %
+                        (count, args.drain_timeout))
+
+        # Retry loop. Terminated sessions take a moment to exit; RENAME fails if any are still around.
+        deadline = time.time() + SWAP_RETRY_TIMEOUT
+        while True:
+            if args.force:
+                terminate(db, [src, dest])
+            try:
+                c.execute("BEGIN")
+                for sql in ("ALTER DATABASE %s RENAME TO %s" % (q_dest, q_backup),
+                            "ALTER DATABASE %s RENAME TO %s" % (q_src, q_dest)):
+                    log.info("SQL: %s", sql)
+                    c.execute(sql)
+                # Re-enable connections in the same transaction, clients never see a missing database.
+                set_allow_connections(db, q_dest, allow_conn[src])
+                set_allow_connections(db, q_backup, allow_conn[dest])
+            except BaseException as err:
+                execute_catch(c, "ROLLBACK")
+                if getattr(err, 'pgcode', None) == psycopg2.errorcodes.OBJECT_IN_USE and args.force:
+                    if time.time() >= deadline:
+                        raise Abort("Sessions could not be terminated within %ds, giving up" % SWAP_RETRY_TIMEOUT)
+                    time.sleep(1)
+                    continue
+                raise
+
+            c.execute("COMMIT")
+            swapped = True
+            break
+    finally:
+        if not swapped:
+            execute_catch(c, "ALTER DATABASE %s WITH ALLOW_CONNECTIONS %s" %
+                          (q_src, 'true' if allow_conn[src] else 'false'))
+            execute_catch(c, "ALTER DATABASE %s WITH ALLOW_CONNECTIONS %s" %
+                          (q_dest, 'true' if allow_conn[dest] else 'false'))
+
+    elapsed = time.time() - blocked
+    log.info("Clients could not connect to %s for %.3fs", q_dest, elapsed)
+
+    if args.no_backup:
+        pg_drop(db, backup_db)
+    return elapsed
+
+
 def pg_move_extended(db, src, dest):
     if args.force and db_exists(db, dest):
+        if db.server_version >= 90500:
+            pg_swap(db, src, dest)
+            return
+
         if args.no_backup:
             pg_drop(db, dest)
         else:
@@ -206,6 +437,97 @@ def pg_move_extended(db, src, dest):
     pg_move(db, src, dest)
 
 
+def pg_analyze(db, q_rel):
+    sql = "ANALYZE %s" % q_rel
+    log.info("SQL: %s", sql)
+    db.cursor().execute(sql)
+
+
+def pg_prewarm(db, q_rel):
+    log.info("Prewarming %s", q_rel)
+    db.cursor().execute("SELECT pg_prewarm(%s::regclass)", [q_rel])
+
+
+def pg_warm_database(src, dest, jobs, size_budget=None):
+    """Run ANALYZE on all tables of dest, then load the hottest relations of src into dest's shared buffers.
+
+    Relations are chosen by the number of block accesses in src until size_budget is full. The default is a quarter of
+    shared_buffers, since the prewarmed blocks evict those of other databases, including src. Prewarming is skipped
+    when the pg_prewarm extension is not installed in dest.
+    """
+    db = connect(src)
+    try:
+        c = db.cursor()
+        if size_budget is None:
+            size_budget = fetch_single_val(c, """\
+            SELECT setting::bigint * pg_catalog.current_setting('block_size')::bigint / 4
+            FROM pg_catalog.pg_settings WHERE name='shared_buffers'
+            """)
+        c.execute("""\
+        SELECT pg_catalog.quote_ident(schemaname) || '.' || pg_catalog.quote_ident(relname),
+            pg_catalog.pg_relation_size(relid)
+        FROM (
+            SELECT schemaname, relname, relid, coalesce(heap_blks_hit, 0) + coalesce(heap_blks_read, 0) AS blks
+            FROM pg_catalog.pg_statio_user_tables
+            UNION ALL
+            SELECT schemaname, indexrelname, indexrelid, coalesce(idx_blks_hit, 0) + coalesce(idx_blks_read, 0)
+            FROM pg_catalog.pg_statio_user_indexes
+        ) s
+        WHERE blks > 0
+        ORDER BY blks DESC
+        """)
+        hot = []
+        total = 0
+        for q_rel, size in c.fetchall():
+            if total + size <= size_budget:
+                hot.append(q_rel)
+                total += size
+    finally:
+        db.close()
+
+    db = connect(dest)
+    try:
+        c = db.cursor()
+        q_dest = quote_names(db, (dest,))[0]
+        # Largest first, so the workers finish at roughly the same time
+        c.execute("""\
+        SELECT pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname)
+        FROM pg_catalog.pg_class c
+            JOIN pg_catalog.pg_namespace n ON (c.relnamespace=n.oid)
+        WHERE c.relkind IN ('r', 'm', 'p') AND n.nspname !~ '^pg_' AND n.nspname != 'information_schema'
+        ORDER BY pg_catalog.pg_relation_size(c.oid) DESC
+        """)
+        tables = [q_rel for (q_rel,) in c]
+        log.info("Analyzing %d table(s) in %s", len(tables), q_dest)
+        run_parallel(dest, pg_analyze, tables, jobs)
+
+        if not has_extension(db, 'pg_prewarm'):
+            log.warning("Extension pg_prewarm is not installed in %s, skipping prewarm", q_dest)
+        else:
+            log.info("Prewarming %d relation(s) size %s in %s", len(hot), pretty_size(total), q_dest)
+            run_parallel(dest, pg_prewarm, hot, jobs)
+    finally:
+        db.close()
+
+
+def pg_warm_index(db, idx):
+    """Restore statistics of a newly built index and load it into shared buffers."""
+    c = db.cursor()
+    q_table, has_exprs = fetch_single_row(c, """\
+    SELECT indrelid::pg_catalog.regclass::text, indexprs IS NOT NULL
+    FROM pg_catalog.pg_index WHERE indexrelid=%s::pg_catalog.regclass
+    """, [idx])
+
+    # Statistics on index expressions are stored with the index, so they were lost with the old one.
+    if has_exprs:
+        pg_analyze(db, q_table)
+
+    if not has_extension(db, 'pg_prewarm'):
+        log.warning("Extension pg_prewarm is not installed, skipping prewarm")
+    else:
+        pg_prewarm(db, idx)
+
+
 #: Parses the output of pg_get_indexdef()
 # This regexp *SHOULD* be SQL injection-safe, but still not 100% certain, it's tricky.
 # Uses negative lookahead/lookbehind to avoid mistaking escaped "" for a "
@@ -217,12 +539,15 @@ def pg_reindex(db, idx):
     c = db.cursor()
 
     # XXX regclass case folding is inconsistent with other PGtool commands, but we can live with it for now.
-    schema, name, stmt, size = fetch_single_row(c, """\
-    SELECT nspname, relname, pg_catalog.pg_get_indexdef(c.oid, 0, true), pg_relation_size(c.oid)
+    schema, name, stmt, size, relkind, is_partition = fetch_single_row(c, """\
+    SELECT nspname, relname, pg_catalog.pg_get_indexdef(c.oid, 0, true), pg_relation_size(c.oid), relkind,
+        EXISTS (SELECT 1 FROM pg_catalog.pg_inherits inh WHERE inh.inhrelid=c.oid)
     FROM pg_catalog.pg_class c
         JOIN pg_catalog.pg_namespace ns ON (c.relnamespace=ns.oid)
     WHERE c.oid=%s::pg_catalog.regclass
     """, [idx])
+    if relkind == 'I' or is_partition:
+        raise Abort("Index %s is partitioned or part of one, use pg_reindex_partitioned()" % idx)
 
     # TODO Generate unique tmp name or drop previous one when safe?
     tmpname = 'tmp_' + name
@@ -288,23 +613,327 @@ def pg_replace_index(db, q_schema, q_source, q_name):
         break
 
 
+def pg_partition_leaves(db, idx, min_size=0, max_age=None):
+    """Find the leaf indexes of a partitioned index, largest first, skipping partitions smaller than min_size bytes.
+
+    With max_age (a PostgreSQL interval), partitions that were not written within that time are considered cold and
+    skipped too: no rows modified since the last ANALYZE, which was longer ago than max_age. Autoanalyze runs after
+    writes, unlike anti-wraparound vacuum. After a statistics reset, partitions count as cold until they are written.
+    Returns a list of schema-qualified index names.
+    """
+    c = db.cursor()
+    # pg_partition_tree() would do, but only exists since PostgreSQL 12
+    c.execute("""\
+    WITH RECURSIVE tree(relid) AS (
+        SELECT %(idx)s::pg_catalog.regclass::pg_catalog.oid
+        UNION ALL
+        SELECT inh.inhrelid FROM pg_catalog.pg_inherits inh JOIN tree ON (inh.inhparent=tree.relid)
+    )
+    SELECT pg_catalog.quote_ident(ns.nspname) || '.' || pg_catalog.quote_ident(c.relname),
+        pg_catalog.pg_relation_size(x.indexrelid),
+        pg_catalog.pg_relation_size(x.indrelid),
+        %(max_age)s::interval IS NOT NULL AND coalesce(t.n_mod_since_analyze, 0) = 0 AND
+            coalesce(greatest(t.last_analyze, t.last_autoanalyze) < pg_catalog.now() - %(max_age)s::interval, true)
+    FROM tree
+        JOIN pg_catalog.pg_class c ON (c.oid=tree.relid)
+        JOIN pg_catalog.pg_namespace ns ON (c.relnamespace=ns.oid)
+        JOIN pg_catalog.pg_index x ON (x.indexrelid=c.oid)
+        LEFT JOIN pg_catalog.pg_stat_all_tables t ON (t.relid=x.indrelid)
+    WHERE c.relkind='i'
+    ORDER BY 3 DESC
+    """, {'idx': idx, 'max_age': max_age})
+
+    leaves = []
+    for q_leaf, size, table_size, cold in c.fetchall():
+        if table_size < min_size:
+            log.info("Skipping index %s size %s, partition is smaller than %s",
+                     q_leaf, pretty_size(size), pretty_size(min_size))
+        elif cold:
+            log.info("Skipping index %s size %s, partition not written within %s", q_leaf, pretty_size(size), max_age)
+        else:
+            leaves.append(q_leaf)
+    return leaves
+
+
+def pg_drop_reindex_leftovers(db, q_idx):
+    """Drop invalid indexes left behind by a failed REINDEX CONCURRENTLY of index q_idx.
+
+    Only indexes named after q_idx are considered, so concurrent rebuilds of other indexes are not disturbed.
+    """
+    c = db.cursor()
+    try:
+        # The server names them <index>_ccnew or _ccold, possibly with a number, truncating <index> to fit 63 bytes.
+        c.execute("""\
+        SELECT q_name FROM (
+            SELECT pg_catalog.quote_ident(ns.nspname) || '.' || pg_catalog.quote_ident(c.relname) AS q_name,
+                c.relname, leaf.relname AS leafname,
+                pg_catalog.regexp_replace(c.relname, '_cc(new|old)[0-9]*$', '') AS base
+            FROM pg_catalog.pg_class leaf
+                JOIN pg_catalog.pg_index lx ON (lx.indexrelid=leaf.oid)
+                JOIN pg_catalog.pg_index x ON (x.indrelid=lx.indrelid)
+                JOIN pg_catalog.pg_class c ON (c.oid=x.indexrelid)
+                JOIN pg_catalog.pg_namespace ns ON (c.relnamespace=ns.oid)
+            WHERE leaf.oid=%s::pg_catalog.regclass AND NOT x.indisvalid AND c.relname ~ '_cc(new|old)[0-9]*$'
+        ) s
+        WHERE base = leafname
+            OR (pg_catalog.octet_length(relname) >= 60 AND base != ''
+                AND pg_catalog.left(leafname, pg_catalog.length(base)) = base)
+        """, [q_idx])
+        leftovers = [q_name for (q_name,) in c.fetchall()]
+    except Exception as err:
+        log.error("Cannot find invalid indexes left behind by REINDEX CONCURRENTLY of %s: %s", q_idx, err)
+        return
+
+    for q_name in leftovers:
+        sql = "DROP INDEX CONCURRENTLY IF EXISTS %s" % q_name
+        log.info("SQL: %s", sql)
+        execute_catch(c, sql)
+
+
+def pg_reindex_partitioned(db, idx, jobs=1, min_size=0, max_age=None, warm=False):
+    """Rebuild the leaf indexes of a partitioned index in parallel, each swapped in on its own. Given a leaf index,
+    only that one is rebuilt.
+
+    Leaf indexes attached to a partitioned index cannot be dropped or renamed, so unlike pg_reindex() this relies on
+    REINDEX INDEX CONCURRENTLY, which does the same build and swap on the server side.
+    """
+    if db.server_version < 120000:
+        raise Abort("Rebuilding partitioned index %s requires PostgreSQL 12 or newer" % idx)
+
+    database = fetch_single_val(db.cursor(), "SELECT pg_catalog.current_database()")
+    leaves = pg_partition_leaves(db, idx, min_size, max_age)
+    log.info("Recreating %d partition index(es) of %s using %d job(s)", len(leaves), idx, min(jobs, len(leaves)))
+
+    def rebuild(leaf_db, q_leaf):
+        sql = "REINDEX INDEX CONCURRENTLY %s" % q_leaf
+        log.info("SQL: %s", sql)
+        try:
+            leaf_db.cursor().execute(sql)
+        except BaseException:
+            # The server does not clean up after a failed REINDEX CONCURRENTLY, the invalid index left behind would
+            # still be maintained on every write.
+            pg_drop_reindex_leftovers(leaf_db, q_leaf)
+            raise
+        if warm:
+            pg_warm_index(leaf_db, q_leaf)
+
+    run_parallel(database, rebuild, leaves, jobs)
+
+
+def split_sql(text, sep=None):
+    """Split SQL text at top-level separators: whitespace by default, or the given character.
+
+    Quoted identifiers, string literals and parenthesized expressions are never split.
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = None
+    for pos, char in enumerate(text):
+        if quote:
+            # Doubled quotes simply close and re-open the quoted string
+            if char == quote:
+                quote = None
+            continue
+
+        if depth == 0 and (char == sep if sep else char.isspace()):
+            if start is not None:
+                parts.append(text[start:pos].strip())
+                start = None
+            continue
+
+        if char in '"\'':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if start is None and not char.isspace():
+            start = pos
+
+    if start is not None:
+        parts.append(text[start:].strip())
+    return parts
+
+
+#: Components of an index definition, as returned by parse_indexdef()
+IndexDef = namedtuple('IndexDef', 'unique name table method columns include predicate')
+
+
+def parse_indexdef(stmt):
+    """Parse the output of pg_get_indexdef() into an IndexDef tuple."""
+    match = re.match(pg_indexdef_re, stmt)
+    assert match, "Cannot parse indexdef statement: %s" % stmt
+
+    tokens = split_sql(match.group(3))
+    if tokens[0] == 'ONLY':
+        tokens.pop(0)
+    table = tokens.pop(0)
+    assert tokens.pop(0) == 'USING', "Cannot parse indexdef statement: %s" % stmt
+    method = tokens.pop(0)
+    columns = tuple(split_sql(tokens.pop(0)[1:-1], ','))
+
+    include = ()
+    predicate = None
+    while tokens:
+        word = tokens.pop(0)
+        if word == 'INCLUDE':
+            include = tuple(split_sql(tokens.pop(0)[1:-1], ','))
+        elif word == 'WHERE':
+            predicate = ' '.join(tokens)
+            break
+        # Storage parameters, TABLESPACE etc. don't matter for comparing indexes
+
+    unique = match.group(1).split()[1] == 'UNIQUE'
+    return IndexDef(unique, match.group(2), table, method, columns, include, predicate)
+
+
+#: Index usage information, as returned by pg_index_usage()
+IndexInfo = namedtuple('IndexInfo', 'oid q_schema q_name table_oid size scans writes constraint definition')
+
+
+def pg_index_usage(db):
+    """Fetch definitions and usage statistics of all valid user indexes in the current database.
+
+    Indexes of partitions attached to a partitioned index are skipped: they cannot be dropped on their own.
+    """
+    c = db.cursor()
+    # Index entries are written on inserts and non-HOT updates; deletes are only cleaned up by vacuum.
+    # An index used as replica identity is needed by logical replication, so treat it like a constraint.
+    c.execute("""\
+    SELECT s.indexrelid, pg_catalog.quote_ident(s.schemaname), pg_catalog.quote_ident(s.indexrelname), s.relid,
+        pg_catalog.pg_relation_size(s.indexrelid), s.idx_scan,
+        coalesce(t.n_tup_ins + t.n_tup_upd - t.n_tup_hot_upd, 0),
+        i.indisreplident OR EXISTS (SELECT 1 FROM pg_catalog.pg_constraint con WHERE con.conindid=s.indexrelid),
+        EXISTS (SELECT 1 FROM pg_catalog.pg_inherits inh WHERE inh.inhrelid=s.indexrelid),
+        pg_catalog.pg_get_indexdef(s.indexrelid, 0, true)
+    FROM pg_catalog.pg_stat_user_indexes s
+        JOIN pg_catalog.pg_index i ON (i.indexrelid=s.indexrelid)
+        JOIN pg_catalog.pg_stat_user_tables t ON (t.relid=s.relid)
+    WHERE i.indisvalid
+    ORDER BY s.schemaname, s.relname, s.indexrelname
+    """)
+
+    indexes = []
+    partitions = 0
+    for row in c.fetchall():
+        if row[-2]:
+            partitions += 1
+            continue
+        indexes.append(IndexInfo(*(row[:-2] + (parse_indexdef(row[-1]),))))
+    if partitions:
+        log.info("Skipping %d index(es) of partitions attached to a partitioned index", partitions)
+    return indexes
+
+
+def find_redundant_indexes(indexes):
+    """Find indexes that duplicate another index, or are a prefix of another index on the same table.
+
+    Returns a list of (index, covering index, reason) tuples. Of two exact duplicates, only one is returned, preferring
+    to keep unique indexes and the one with more scans. Indexes that enforce a constraint are never returned.
+    """
+    def keep_rank(idx):
+        return idx.constraint, idx.definition.unique, idx.scans
+
+    found = []
+    for idx in indexes:
+        if idx.constraint:
+            continue
+        defn = idx.definition
+
+        for other in indexes:
+            other_defn = other.definition
+            if (other is idx or other.table_oid != idx.table_oid or other_defn.method != defn.method or
+                    other_defn.predicate != defn.predicate):
+                continue
+
+            if other_defn.columns == defn.columns and other_defn.include == defn.include:
+                # Exact duplicate: keep the "more important" one, or the one sorting first by name.
+                if (keep_rank(other), idx.q_name) > (keep_rank(idx), other.q_name):
+                    found.append((idx, other, "duplicate"))
+                    break
+
+            # Only btree indexes can be used for a scan on the leading columns.
+            elif (defn.method == 'btree' and not defn.unique and not defn.include and
+                  other_defn.columns[:len(defn.columns)] == defn.columns):
+                found.append((idx, other, "prefix"))
+                break
+
+    return found
+
+
+def find_unneeded_indexes(indexes, max_scans):
+    """Find redundant indexes (see find_redundant_indexes()) and indexes with at most max_scans scans.
+
+    An index covering a redundant one is never reported as unused, so both are never dropped together.
+    Returns a list of (index, reason) tuples.
+    """
+    redundant = find_redundant_indexes(indexes)
+    findings = [(idx, "%s of %s" % (reason, other.q_name)) for idx, other, reason in redundant]
+    skip = set(idx.oid for idx, other, reason in redundant) | set(other.oid for idx, other, reason in redundant)
+    for idx in indexes:
+        if (idx.scans <= max_scans and not idx.definition.unique and not idx.constraint and
+                idx.oid not in skip):
+            findings.append((idx, "%d scans" % idx.scans))
+    return findings
+
+
+def pg_drop_index(db, q_schema, q_name):
+    """Drop an index using DROP INDEX CONCURRENTLY, retrying with a short lock timeout until it succeeds."""
+    c = db.cursor()
+    timeout_var = 'lock_timeout' if db.server_version >= 90300 else 'statement_timeout'
+
+    # DROP INDEX CONCURRENTLY cannot run in a transaction block, so set the timeout for the session.
+    c.execute("SET %s='1s'" % timeout_var)
+    try:
+        # Retry loop. XXX This may never complete on very busy systems?
+        while True:
+            try:
+                sql = "DROP INDEX CONCURRENTLY IF EXISTS %s.%s" % (q_schema, q_name)
+                log.info("SQL: %s", sql)
+                c.execute(sql)
+
+            except BaseException as err:
+                if getattr(err, 'pgcode', None) in (psycopg2.errorcodes.LOCK_NOT_AVAILABLE,
+                                                    psycopg2.errorcodes.QUERY_CANCELED):
+                    time.sleep(1)
+                    continue
+                raise
+
+            break
+    finally:
+        execute_catch(c, "RESET %s" % timeout_var)
+
+
 def cmd_copy():
     """Uses CREATE DATABASE ... TEMPLATE to create a duplicate of a database. Additionally copies over database-specific
     settings.
 
     When used with --force, an existing database with the same name as DEST is replaced, the original is renamed out of
     place in the form DEST_old_YYYYMMDD (unless --no-backup is specified).
+
+    With --warm, the new database is analyzed and the relations most used in SOURCE are loaded into the cache using
+    pg_prewarm, before it is put in place. Prewarming evicts cached data of other databases on the server, including
+    SOURCE, so by default it is limited to a quarter of shared_buffers; use --warm-size to change this.
+
+    On PostgreSQL 15 and newer, the copy STRATEGY is chosen from the size of SOURCE, the number of attached replicas
+    and the WAL volume since the last checkpoint, unless given with --strategy. Databases smaller than
+    --strategy-threshold always use WAL_LOG.
     """
     db = connect()
 
     if args.force and db_exists(db, args.dest):
         tmp_db = generate_alt_dbname(db, args.dest, 'tmp')
         pg_copy(db, args.src, tmp_db)
+        if args.warm:
+            pg_warm_database(args.src, tmp_db, args.jobs, args.warm_size)
 
         pg_move_extended(db, tmp_db, args.dest)
 
     else:
         pg_copy(db, args.src, args.dest)
+        if args.warm:
+            pg_warm_database(args.src, args.dest, args.jobs, args.warm_size)
 
 
 def cmd_move(db=None):
@@ -319,6 +948,55 @@ def cmd_move(db=None):
     pg_move_extended(db, args.src, args.dest)
 
 
+def cmd_swap():
+    """Replace database DEST with SOURCE, renaming the original DEST out of place in the form DEST_old_YYYYMMDD (it is
+    dropped afterwards with --no-backup).
+
+    Connections to both databases are disabled, sessions are given --drain-timeout seconds to disconnect (with --force,
+    remaining ones are terminated), then both renames are done in one transaction, retried for up to 30 seconds while
+    sessions exit. Reports the time during which clients could not connect. Requires PostgreSQL 9.5 or newer. With
+    --force, cp and mv use the same procedure.
+    """
+    db = connect()
+    pg_swap(db, args.src, args.dest)
+
+
+def cmd_indexes():
+    """Reports unused indexes and indexes that duplicate, or are a prefix of, another index on the same table.
+
+    Indexes enforcing a constraint or used as replica identity are never reported, nor unused indexes that make
+    another one redundant. Indexes of partitions attached to a partitioned index are skipped. The write cost is
+    estimated from the number of inserted and non-HOT updated rows of the table since statistics were last reset.
+    Scan counts don't include scans on standby servers, and start again from 0 for an index rebuilt by reindex, so
+    review the report before using --drop. With --drop, the reported indexes are removed using DROP INDEX
+    CONCURRENTLY, retrying with a short lock timeout.
+    """
+    db = connect(args.database)
+    c = db.cursor()
+
+    stats_reset = fetch_single_val(c, "SELECT stats_reset FROM pg_catalog.pg_stat_database "
+                                      "WHERE datname=pg_catalog.current_database()")
+    log.info("Statistics collected since %s", stats_reset or "(never reset)")
+
+    log.info("Scans on standby servers are not counted, and indexes rebuilt by reindex start again from 0 scans")
+
+    findings = find_unneeded_indexes(pg_index_usage(db), args.max_scans)
+    if not findings:
+        log.info("No unused or redundant indexes found")
+        return
+
+    for idx, reason in findings:
+        log.info("Index %s.%s size %s: %s, est. %d index writes", idx.q_schema, idx.q_name, pretty_size(idx.size),
+                 reason, idx.writes)
+    log.info("Total %d index(es) size %s, est. %d index writes",
+             len(findings), pretty_size(sum(idx.size for idx, reason in findings)),
+             sum(idx.writes for idx, reason in findings))
+
+    if args.drop:
+        for idx, reason in findings:
+            pg_drop_index(db, idx.q_schema, idx.q_name)
+
+
 def cmd_kill():
     """Kills all active connections to the specified database(s)."""
     db = connect()
@@ -333,11 +1011,27 @@ def cmd_reindex():
     """Uses CREATE INDEX CONCURRENTLY to create a duplicate index, then tries to swap the new index for the original.
 
     The index swap is done using a short lock timeout to prevent it from interfering with running queries. Retries until
-    the rename succeeds.
+    the rename succeeds. With --warm, the new index is loaded into the cache using pg_prewarm.
+
+    Partitioned indexes, and indexes of their partitions, are rebuilt one partition at a time with REINDEX INDEX
+    CONCURRENTLY, in parallel with --jobs (requires PostgreSQL 12 or newer). Use --min-size and --max-age to rebuild
+    only large or recently written partitions.
     """
     db = connect(args.database)
+    c = db.cursor()
     for idx in args.indexes:
+        # Indexes of partitions attached to a partitioned index cannot be dropped on their own either
+        partitioned = fetch_single_val(c, """\
+        SELECT c.relkind = 'I' OR EXISTS (SELECT 1 FROM pg_catalog.pg_inherits inh WHERE inh.inhrelid=c.oid)
+        FROM pg_catalog.pg_class c WHERE c.oid=%s::pg_catalog.regclass
+        """, [idx])
+        if partitioned:
+            pg_reindex_partitioned(db, idx, args.jobs, args.min_size, args.max_age, args.warm)
+            continue
+
         pg_reindex(db, idx)
+        if args.warm:
+            pg_warm_index(db, idx)
 
 
 COMMANDS = {
@@ -345,6 +1039,8 @@ COMMANDS = {
     'mv': cmd_move,
     'kill': cmd_kill,
     'reindex': cmd_reindex,
+    'indexes': cmd_indexes,
+    'swap': cmd_swap,
 }
 
 
@@ -366,6 +1062,12 @@ def make_argparser():
     else:
         unicode_arg = str
 
+    def positive_int(val):
+        val = int(val)
+        if val < 1:
+            raise ArgumentTypeError("must be at least 1")
+        return val
+
     # Generic options
     p_main = ArgumentParser()
     generic = p_main.add_argument_group("generic arguments")
@@ -389,8 +1091,10 @@ def make_argparser():
                           help="Create a copy of a database within a server")
     p_mv = sub.add_parser('mv', description=cmd_move.__doc__,
                           help="Rename a database within a server")
+    p_swap = sub.add_parser('swap', description=cmd_swap.__doc__,
+                            help="Replace a database with another with minimal downtime")
 
-    for p_cmd in (p_cp, p_mv):
+    for p_cmd in (p_cp, p_mv, p_swap):
         p_cmd.add_argument('src', metavar="SOURCE", type=unicode_arg,
                            help="source database name")
         p_cmd.add_argument('dest', metavar="DEST", type=unicode_arg,
@@ -398,6 +1102,21 @@ def make_argparser():
         p_cmd.add_argument("--no-backup",
                            action='store_true', dest='no_backup', default=False,
                            help="drop existing DEST database if it exists")
+        p_cmd.add_argument("--drain-timeout", metavar="SECS", type=float, dest='drain_timeout', default=0,
+                           help="when replacing DEST, wait up to SECS seconds for sessions to disconnect (default: 0)")
+
+    p_cp.add_argument("--warm", action='store_true', default=False,
+                      help="analyze the new database and prewarm the relations most used in SOURCE")
+    p_cp.add_argument("--warm-size", metavar="SIZE", type=parse_size, dest='warm_size',
+                      help="prewarm up to SIZE bytes, e.g. 2G. This evicts cached data of other databases on the "
+                           "server, including SOURCE (default: 1/4 of shared_buffers)")
+    p_cp.add_argument("-j", "--jobs", metavar="N", type=positive_int, default=4,
+                      help="use N parallel connections for warming (default: 4)")
+    p_cp.add_argument("--strategy", choices=('auto', 'wal_log', 'file_copy'), default='auto',
+                      help="CREATE DATABASE strategy, PostgreSQL 15+ (default: auto)")
+    p_cp.add_argument("--strategy-threshold", metavar="SIZE", type=parse_size, dest='strategy_threshold',
+                      default=parse_size('64M'),
+                      help="always use WAL_LOG strategy for databases smaller than SIZE (default: 64M)")
 
     p_kill = sub.add_parser('kill', description=cmd_kill.__doc__,
                             help="Terminate active connections to a database")
@@ -408,9 +1127,27 @@ def make_argparser():
                                help="Gracefully recreate an index")
     p_reindex.add_argument('-d', '--database', metavar="DB", type=unicode_arg,
                            help="apply reindex in this database")
+    p_reindex.add_argument("--warm", action='store_true', default=False,
+                           help="prewarm the new index")
+    p_reindex.add_argument("-j", "--jobs", metavar="N", type=positive_int, default=1,
+                           help="rebuild N partitions of a partitioned index in parallel (default: 1)")
+    p_reindex.add_argument("--min-size", metavar="SIZE", type=parse_size, dest='min_size', default=0,
+                           help="skip partitions smaller than SIZE, e.g. 100M")
+    p_reindex.add_argument("--max-age", metavar="INTERVAL", type=unicode_arg, dest='max_age',
+                           help="skip partitions with no writes since their last analyze, if that was longer than "
+                                "INTERVAL ago, e.g. '7 days'")
     p_reindex.add_argument('indexes', metavar="IDXNAME", type=unicode_arg, nargs='+',
                            help="reindex these indexes")
 
+    p_indexes = sub.add_parser('indexes', description=cmd_indexes.__doc__,
+                               help="Find unused and redundant indexes")
+    p_indexes.add_argument('-d', '--database', metavar="DB", type=unicode_arg,
+                           help="analyze indexes in this database")
+    p_indexes.add_argument('--max-scans', metavar="N", type=int, default=0,
+                           help="report indexes with at most N scans (default: 0)")
+    p_indexes.add_argument('--drop', action='store_true', default=False,
+                           help="drop the reported indexes")
+
     return p_main
 
 
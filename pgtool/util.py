@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 import math
+import re
 
 
 def pretty_size(value):
@@ -20,6 +21,15 @@ def pretty_size(value):
     return '%.*f%s' % (2 - places, unit_value, unit)
 
 
+def parse_size(value):
+    """Convert a human-readable size, such as 512M or 1.5GB, into a number of bytes. Units are powers of 1024."""
+    match = re.match(r'^\s*([0-9]+(?:\.[0-9]*)?)\s*([kMGTPEZY]?)B?\s*$', value, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size: %s" % value)
+    exp = 'bkmgtpezy'.index(match.group(2).lower()) if match.group(2) else 0
+    return int(float(match.group(1)) * 1024 ** exp)
+
+
 def fetch_single_row(c, sql, vars=None):
     c.execute(sql, vars)
     assert c.rowcount == 1, "Unexpected %d rows" % c.rowcount
@@ -32,6 +32,12 @@ class ArgumentTest(unittest.TestCase):
             parser.parse_args(['kill', 'foo', '--no-backup'])
         # mv does
         parser.parse_args(['mv', 'foo', 'bar', '--no-backup'])
+        parser.parse_args(['swap', 'foo', 'bar', '--no-backup', '--drain-timeout', '2.5'])
+        parser.parse_args(['cp', 'foo', 'bar', '--strategy', 'file_copy', '--strategy-threshold', '1G'])
+        with self.assertRaises(SystemExit, msg="1"):
+            parser.parse_args(['cp', 'foo', 'bar', '--strategy', 'foo'])
+        with self.assertRaises(SystemExit, msg="1"):
+            parser.parse_args(['reindex', '-j', '0', 'foo'])
         # but not before the command itself
         with self.assertRaises(SystemExit, msg="1"):
             parser.parse_args(['--no-backup', 'mv', 'foo', 'bar'])
@@ -43,6 +43,36 @@ class MicroTest(unittest.TestCase):
         self.assertTrue(pgtool.db_exists(self.db, 'template0'))  # This database should be un-droppable
         self.assertFalse(pgtool.db_exists(self.db, 'such a long database name could not possibly exist in PostgreSQL'))
 
+    def test_run_parallel(self):
+        """Test running queries over multiple connections"""
+        results = []
+
+        def func(db, item):
+            results.append(fetch_single_val(db.cursor(), "SELECT %s * 2", [item]))
+
+        pgtool.run_parallel(None, func, list(range(10)), 3)
+        self.assertEqual(sorted(results), list(range(0, 20, 2)))
+
+        with self.assertRaises(psycopg2.DataError):
+            pgtool.run_parallel(None, func, ['x'], 3)
+
+    def test_swap(self):
+        """Test swapping databases"""
+        c = self.db.cursor()
+        for name in ('pgtool_swap_a', 'pgtool_swap_b'):
+            c.execute("DROP DATABASE IF EXISTS %s" % name)
+            c.execute("CREATE DATABASE %s TEMPLATE template0" % name)
+        oid_a = fetch_single_val(c, "SELECT oid FROM pg_database WHERE datname='pgtool_swap_a'")
+
+        pgtool.args = pgtool.make_argparser().parse_args(['swap', 'pgtool_swap_a', 'pgtool_swap_b', '--no-backup'])
+        elapsed = pgtool.pg_swap(self.db, 'pgtool_swap_a', 'pgtool_swap_b')
+        self.assertTrue(elapsed >= 0)
+
+        self.assertFalse(pgtool.db_exists(self.db, 'pgtool_swap_a'))
+        c.execute("SELECT oid, datallowconn FROM pg_database WHERE datname='pgtool_swap_b'")
+        self.assertEqual(c.fetchone(), (oid_a, True))
+        c.execute("DROP DATABASE pgtool_swap_b")
+
     def test_alt_dbname(self):
         """Test generation of temp/backup database names"""
         self.assertEqual(pgtool.generate_alt_dbname(self.db, 'template0'), time.strftime('template0_tmp_%Y%m%d'))
@@ -51,6 +81,60 @@ class MicroTest(unittest.TestCase):
             time.strftime('such a long database name could not possibly exist_tmp_%Y%m%d'))
 
 
+def make_index(oid, stmt, table_oid=1, scans=0, constraint=False):
+    defn = pgtool.parse_indexdef(stmt)
+    return pgtool.IndexInfo(oid, 'public', defn.name, table_oid, 8192, scans, 0, constraint, defn)
+
+
+class IndexdefTest(unittest.TestCase):
+    def test_split_sql(self):
+        self.assertEqual(pgtool.split_sql('a  "b c" (d, e)'), ['a', '"b c"', '(d, e)'])
+        self.assertEqual(pgtool.split_sql('a, lower((b || \',\')), "c,""" DESC', ','),
+                         ['a', 'lower((b || \',\'))', '"c,""" DESC'])
+
+    def test_parse_indexdef(self):
+        defn = pgtool.parse_indexdef('CREATE UNIQUE INDEX "x ON y" ON s."t USING z" USING btree (a, lower(b)) '
+                                     'INCLUDE (c) WHERE (a IS NOT NULL)')
+        self.assertEqual(defn, (True, '"x ON y"', 's."t USING z"', 'btree', ('a', 'lower(b)'), ('c',),
+                                '(a IS NOT NULL)'))
+
+        defn = pgtool.parse_indexdef('CREATE INDEX i ON ONLY t USING gist (p) WITH (fillfactor=50)')
+        self.assertEqual(defn, (False, 'i', 't', 'gist', ('p',), (), None))
+
+    def test_redundant_indexes(self):
+        idx1 = make_index(1, "CREATE INDEX idx1 ON t USING btree (a)")
+        idx2 = make_index(2, "CREATE INDEX idx2 ON t USING btree (a, b)")
+        idx3 = make_index(3, "CREATE INDEX idx3 ON t USING btree (a, b)", scans=1)
+        idx4 = make_index(4, "CREATE UNIQUE INDEX idx4 ON t USING btree (a)", constraint=True)
+        idx5 = make_index(5, "CREATE INDEX idx5 ON t USING btree (a) WHERE (b > 0)")
+        idx6 = make_index(6, "CREATE INDEX idx6 ON t USING hash (a)")
+        idx7 = make_index(7, "CREATE INDEX idx7 ON t2 USING btree (a)", table_oid=2)
+
+        found = pgtool.find_redundant_indexes([idx1, idx2, idx3, idx4, idx5, idx6, idx7])
+        self.assertEqual([(idx.oid, other.oid, reason) for idx, other, reason in found],
+                         [(1, 2, "prefix"), (2, 3, "duplicate")])
+
+    def test_unneeded_indexes(self):
+        # Unused index covering a used one must not be dropped along with it
+        idx_a = make_index(1, "CREATE INDEX idx_a ON t USING btree (a)", scans=5000)
+        idx_ab = make_index(2, "CREATE INDEX idx_ab ON t USING btree (a, b)", scans=0)
+        idx_c = make_index(3, "CREATE INDEX idx_c ON t USING btree (c)", scans=0)
+
+        found = pgtool.find_unneeded_indexes([idx_a, idx_ab, idx_c], 0)
+        self.assertEqual([(idx.q_name, reason) for idx, reason in found],
+                         [('idx_a', "prefix of idx_ab"), ('idx_c', "0 scans")])
+
+
+class CopyStrategyTest(unittest.TestCase):
+    def test_choose_copy_strategy(self):
+        mb = 1024 ** 2
+        self.assertEqual(pgtool.choose_copy_strategy(10 * mb, 2, 0, 64 * mb), 'WAL_LOG')
+        self.assertEqual(pgtool.choose_copy_strategy(100 * mb, 0, None, 64 * mb), 'FILE_COPY')
+        self.assertEqual(pgtool.choose_copy_strategy(100 * mb, 0, 10 * mb, 64 * mb), 'FILE_COPY')
+        self.assertEqual(pgtool.choose_copy_strategy(100 * mb, 0, 500 * mb, 64 * mb), 'WAL_LOG')
+        self.assertEqual(pgtool.choose_copy_strategy(100 * mb, 5, 500 * mb, 64 * mb), 'FILE_COPY')
+
+
 def get_rel_oid(c, relname):
     return fetch_single_val(c, "SELECT %s::regclass::int", [relname])
 
@@ -151,6 +235,108 @@ class OperationTest(unittest.TestCase):
         """)
         self.assertEqual(c.fetchone()[0], ['reindex_idx2'])
 
+    def test_reindex_partitioned(self):
+        """Test reindex of each partition of a partitioned index"""
+        if self.db.server_version < 120000:
+            self.skipTest("REINDEX CONCURRENTLY requires PostgreSQL 12")
+
+        c = self.db.cursor()
+        c.execute("""\
+        CREATE TABLE part_tbl (id int) PARTITION BY RANGE (id);
+        CREATE TABLE part_tbl_1 PARTITION OF part_tbl FOR VALUES FROM (0) TO (10);
+        CREATE TABLE part_tbl_2 PARTITION OF part_tbl FOR VALUES FROM (10) TO (20);
+        INSERT INTO part_tbl_2 VALUES (15);
+        CREATE INDEX part_idx ON part_tbl(id);
+        """)
+        oid1 = get_rel_oid(c, 'part_tbl_1_id_idx')
+        oid2 = get_rel_oid(c, 'part_tbl_2_id_idx')
+
+        # Reindex only the non-empty partition
+        pgtool.pg_reindex_partitioned(self.db, 'part_idx', jobs=2, min_size=1)
+        self.assertEqual(get_rel_oid(c, 'part_tbl_1_id_idx'), oid1)
+        self.assertNotEqual(get_rel_oid(c, 'part_tbl_2_id_idx'), oid2)
+
+        with self.assertRaises(pgtool.Abort):
+            pgtool.pg_reindex(self.db, 'part_idx')
+        with self.assertRaises(pgtool.Abort):
+            pgtool.pg_reindex(self.db, 'part_tbl_1_id_idx')
+
+        # A single leaf index can be given too
+        pgtool.pg_reindex_partitioned(self.db, 'part_tbl_1_id_idx')
+        self.assertNotEqual(get_rel_oid(c, 'part_tbl_1_id_idx'), oid1)
+
+    def test_reindex_leftovers(self):
+        """Test cleanup of invalid indexes after a failed REINDEX CONCURRENTLY"""
+        c = self.db.cursor()
+        c.execute("""\
+        CREATE TABLE leftover_tbl (id int);
+        INSERT INTO leftover_tbl VALUES (1), (1);
+        CREATE INDEX leftover_idx ON leftover_tbl(id);
+        """)
+        # Create invalid indexes. IntegrityError: could not create unique index
+        for name in ('leftover_idx_ccnew', 'leftover_idx_ccnew1', 'other_idx_ccnew'):
+            with self.assertRaises(psycopg2.IntegrityError):
+                c.execute("CREATE UNIQUE INDEX CONCURRENTLY %s ON leftover_tbl(id)" % name)
+
+        pgtool.pg_drop_reindex_leftovers(self.db, 'leftover_idx')
+        c.execute("""\
+        SELECT array_agg(indexrelid::regclass::text ORDER BY indexrelid::regclass::text) FROM pg_catalog.pg_index
+            WHERE indrelid='pgtool_test.leftover_tbl'::regclass
+        """)
+        self.assertEqual(c.fetchone()[0], ['leftover_idx', 'other_idx_ccnew'])
+
+    def test_warm_index(self):
+        """Test restoring statistics of an expression index"""
+        c = self.db.cursor()
+        c.execute("CREATE INDEX warm_idx ON reindex_tbl(lower(txt))")
+        pgtool.pg_warm_index(self.db, 'warm_idx')
+
+        c.execute("SELECT count(*) FROM pg_stats WHERE tablename='warm_idx'")
+        self.assertEqual(c.fetchone()[0], 1)
+
+    def test_index_usage(self):
+        """Test finding and dropping a duplicate index"""
+        c = self.db.cursor()
+        c.execute("CREATE INDEX dup_idx1 ON reindex_tbl(txt); CREATE INDEX dup_idx2 ON reindex_tbl(txt)")
+
+        indexes = [idx for idx in pgtool.pg_index_usage(self.db) if idx.q_name in ('dup_idx1', 'dup_idx2')]
+        found = pgtool.find_redundant_indexes(indexes)
+        self.assertEqual([(idx.q_name, other.q_name) for idx, other, reason in found], [('dup_idx2', 'dup_idx1')])
+
+        pgtool.pg_drop_index(self.db, 'pgtool_test', 'dup_idx2')
+        c.execute("SELECT to_regclass('pgtool_test.dup_idx2')")
+        self.assertIsNone(c.fetchone()[0])
+
+    def test_index_usage_replident(self):
+        """Test that an index used as replica identity is not reported as duplicate"""
+        c = self.db.cursor()
+        c.execute("""\
+        CREATE TABLE replident_tbl (id int PRIMARY KEY);
+        CREATE UNIQUE INDEX replident_idx ON replident_tbl(id);
+        ALTER TABLE replident_tbl REPLICA IDENTITY USING INDEX replident_idx;
+        """)
+
+        indexes = [idx for idx in pgtool.pg_index_usage(self.db) if idx.q_name.startswith('replident_')]
+        self.assertEqual(len(indexes), 2)
+        self.assertEqual(pgtool.find_redundant_indexes(indexes), [])
+
+    def test_index_usage_partitioned(self):
+        """Test that indexes of partitions are not reported"""
+        if self.db.server_version < 110000:
+            self.skipTest("Partitioned indexes require PostgreSQL 11")
+
+        c = self.db.cursor()
+        c.execute("""\
+        CREATE TABLE partdup_tbl (id int) PARTITION BY RANGE (id);
+        CREATE TABLE partdup_tbl_1 PARTITION OF partdup_tbl FOR VALUES FROM (0) TO (10);
+        CREATE INDEX partdup_idx1 ON partdup_tbl(id);
+        CREATE INDEX partdup_idx2 ON partdup_tbl(id);
+        CREATE INDEX partdup_own_idx ON partdup_tbl_1(id);
+        """)
+
+        names = [idx.q_name for idx in pgtool.pg_index_usage(self.db) if idx.q_name.startswith('partdup_')]
+        self.assertEqual(names, ['partdup_own_idx'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 
 import unittest
 
-from pgtool.util import pretty_size
+from pgtool.util import pretty_size, parse_size
 
 
 class UtilTest(unittest.TestCase):
@@ -28,6 +28,22 @@ class UtilTest(unittest.TestCase):
         for key, value in testcases.items():
             self.assertEqual(value, pretty_size(key))
 
+    def test_parse_size(self):
+        testcases = {
+            '0': 0,
+            '42b': 42,
+            '1k': 1024,
+            '1.5M': 1536 * 1024,
+            '2 GB': 2 * 1024 ** 3,
+            '1t': 1024 ** 4,
+        }
+        for key, value in testcases.items():
+            self.assertEqual(value, parse_size(key))
+
+        for value in ('', 'M', '1X', '-1k'):
+            with self.assertRaises(ValueError):
+                parse_size(value)
+
 
 if __name__ == '__main__':
     unittest.main()